@@ -1,9 +1,14 @@
 import os
+import heapq
+import operator
 import subprocess
+import time
 import shutil
 from pathlib import Path
 
 import socket
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuration
 SOURCE_DIRS = [
@@ -14,89 +19,177 @@ SOURCE_DIRS = [
     os.path.expanduser("~/Music")
 ]
 
+# (source, source + os.sep, basename) per source, computed once for prefix checks
+_SOURCE_PREFIXES = [(s, s + os.sep, os.path.basename(s)) for s in SOURCE_DIRS]
+
 WEBDAV_URL = "https://file.kabizhu.heiyu.space/dav/CloudRelay"
 MOUNT_POINT = "/Volumes/CloudRelay"
+MOUNT_TIMEOUT = 60 # seconds to wait for the volume before asking the user
 DEVICE_NAME = socket.gethostname().split('.')[0] # e.g., "tetsuya-mac"
 
-def get_file_size(path):
+_LARGE_FILE = 1024 * 1024 # Only track files > 1MB
+
+# Directory names skipped by the scan; mirrors the rsync --exclude list so
+# we never walk into trees that will not be backed up anyway
+_PRUNE_NAMES = frozenset({
+    ".git", "venv", ".venv", "node_modules", "__pycache__",
+    ".cache", ".npm", "build", "dist",
+    ".Trashes", ".TemporaryItems", ".localized",
+})
+
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB")
+
+def format_size(size):
+    if size == 0: return "0 B"
+    # Each unit is 2**10 of the previous one, so bit_length picks it without a loop
+    i = min((int(size).bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size / (1 << (10 * i)):.2f} {_SIZE_UNITS[i]}"
+
+def _push_bounded(heap, limit, item):
+    """Keeps heap as a min-heap of the 'limit' largest (size, path) items."""
+    if len(heap) < limit:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+def _lstat_size(entry):
+    """Size of a DirEntry without following symlinks, or 0 if it vanished."""
     try:
-        return os.path.getsize(path)
+        return entry.stat(follow_symlinks=False).st_size
     except OSError:
         return 0
 
-def format_size(size):
-    if size == 0: return "0 B"
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size < 1024:
-            return f"{size:.2f} {unit}"
-        size /= 1024
+def _scan(dir_path, heap, limit, dir_sizes, subdirs=None, dev=None):
+    """Recursively scans dir_path with os.scandir and returns its total size.
+
+    Files > _LARGE_FILE are kept in heap as (size, path), bounded to the 'limit'
+    largest (see _push_bounded), and dir_sizes maps
+    every visited directory to its total size (own files + all children).
+    If subdirs is a list, child directories are appended to it instead of
+    being descended into, and only the directory's own files are counted.
+    Symlinks are never followed and directories on another device than
+    dir_path (e.g. a mounted network share) are skipped.
+    """
+    file_entries = []
+    children = []
+    try:
+        fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return 0
+    try:
+        if dev is None:
+            dev = os.fstat(fd).st_dev
+        # Scanning through the dir fd makes entry.stat() an fstatat() on the bare
+        # name, so the kernel never re-resolves the full path for each file.
+        # entry.path is then just the name; full paths are built only when kept.
+        with os.scandir(fd) as it:
+            for entry in it:
+                try:
+                    # is_dir/is_file are served from the readdir d_type, no stat needed
+                    if entry.is_dir(follow_symlinks=False):
+                        # Prune unwanted directories and anything mounted below the source
+                        if entry.name not in _PRUNE_NAMES and entry.stat(follow_symlinks=False).st_dev == dev:
+                            children.append(os.path.join(dir_path, entry.name))
+                    elif entry.is_file(follow_symlinks=False):
+                        # Symlinks and special files never reach here
+                        file_entries.append(entry)
+                except OSError:
+                    continue
+            
+            # One lstat per file in a tight comprehension; only if a file vanished
+            # mid-scan do we redo it entry by entry
+            try:
+                sizes = [e.stat(follow_symlinks=False).st_size for e in file_entries]
+            except OSError:
+                sizes = [_lstat_size(e) for e in file_entries]
+    except OSError:
+        return 0
+    finally:
+        # Close before recursing so deep trees don't pile up open descriptors per thread
+        os.close(fd)
+    
+    total = sum(sizes)
+    for e, size in zip(file_entries, sizes):
+        if size > _LARGE_FILE:
+            _push_bounded(heap, limit, (size, os.path.join(dir_path, e.name)))
+    
+    if subdirs is not None:
+        subdirs.extend(children)
+    else:
+        for child in children:
+            total += _scan(child, heap, limit, dir_sizes, dev=dev)
+    dir_sizes[dir_path] = total
+    return total
+
+def _scan_root(root, limit):
+    """Worker task: scans one root and returns (local_heap, local_dir_sizes, total)."""
+    local_heap = []
+    local_dir_sizes = {}
+    total = _scan(root, local_heap, limit, local_dir_sizes)
+    return local_heap, local_dir_sizes, total
 
 def list_large_items(limit=20):
     print("\n" + "="*50)
     print("🔍 SCANNING DIRECTORIES FOR LARGE ITEMS")
     print("="*50)
     
-    all_files = []
-    dir_sizes = {}
+    heap = []
+    dir_sizes = defaultdict(int)
     
+    # One shallow pass per source; its immediate subdirectories become the scan roots
+    roots = []
+    scanned_sources = set()
     for source in SOURCE_DIRS:
         if not os.path.exists(source):
             continue
         print(f"Scanning: {source}...")
-        for root, dirs, filenames in os.walk(source):
-            # Prune unwanted directories from scan
-            dirs[:] = [d for d in dirs if d not in [".git", "venv", ".venv", "node_modules", "__pycache__", "build", "dist"]]
-            
-            current_dir_size = 0
-            for f in filenames:
-                file_path = os.path.join(root, f)
-                size = get_file_size(file_path)
-                if size > 1024 * 1024: # Only track files > 1MB
-                    all_files.append((file_path, size))
-                current_dir_size += size
-            
-            # Accumulate size for current dir and all parents up to 'source'
-            temp_path = root
-            while True:
-                dir_sizes[temp_path] = dir_sizes.get(temp_path, 0) + current_dir_size
-                if temp_path == source or temp_path == os.path.dirname(source):
-                    break
-                temp_path = os.path.dirname(temp_path)
+        scanned_sources.add(source)
+        _scan(source, heap, limit, dir_sizes, subdirs=roots)
     
-    # Sort files
-    all_files.sort(key=lambda x: x[1], reverse=True)
+    # Scanning is I/O-bound and scandir/stat release the GIL, so threads overlap the syscalls
+    if roots:
+        with ThreadPoolExecutor(max_workers=min(32, len(roots))) as executor:
+            results = executor.map(lambda root: _scan_root(root, limit), roots)
+            for root, (local_heap, local_dir_sizes, total) in zip(roots, results):
+                for item in local_heap:
+                    _push_bounded(heap, limit, item)
+                dir_sizes.update(local_dir_sizes)
+                # Roll each subtree total into its source's own-file size
+                source = os.path.dirname(root)
+                dir_sizes[source] += total
     
-    # Sort all directories by size
-    raw_sorted_dirs = sorted(
-        [(d, s) for d, s in dir_sizes.items() if any(d.startswith(src) and d != src for src in SOURCE_DIRS)],
-        key=lambda x: x[1],
-        reverse=True
+    # The heap already holds only the largest files; order them for display
+    top_files = [(path, size) for size, path in sorted(heap, reverse=True)]
+    
+    # Every non-source entry in dir_sizes was found below a source, so dropping the
+    # sources is a set lookup. Sort by path so every child directly follows its parent.
+    # os.sep is mapped to "\0" so "A/B" sorts before siblings like "A B".
+    path_sorted = sorted(
+        ((d, s) for d, s in dir_sizes.items() if d not in scanned_sources),
+        key=lambda x: x[0].replace(os.sep, "\0")
     )
     
     # Deduplicate: If a parent is already in the list, skip its children
     # This avoids listing A, A/B, A/B/C separately when they are all "large"
     deduped_dirs = []
-    for d_path, d_size in raw_sorted_dirs:
-        # Check if any parent of d_path is already in deduped_dirs
-        is_redundant = False
-        for existing_path, _ in deduped_dirs:
-            if d_path.startswith(existing_path + os.sep) or d_path == existing_path:
-                is_redundant = True
-                break
-        if not is_redundant:
-            deduped_dirs.append((d_path, d_size))
-        if len(deduped_dirs) >= limit:
-            break
+    last_kept_prefix = None
+    for d_path, d_size in path_sorted:
+        if last_kept_prefix is not None and d_path.startswith(last_kept_prefix):
+            continue
+        deduped_dirs.append((d_path, d_size))
+        last_kept_prefix = d_path + os.sep
+    
+    deduped_dirs = heapq.nlargest(limit, deduped_dirs, key=operator.itemgetter(1))
     
     print(f"\n🔝 TOP {limit} LARGEST FILES:")
-    for i, (path, size) in enumerate(all_files[:limit], 1):
+    for i, (path, size) in enumerate(top_files, 1):
         print(f"F{i:02d}. [{format_size(size):>10}] {path}")
         
     print(f"\n📂 TOP {limit} LARGEST DIRECTORIES (Deduplicated):")
     for i, (path, size) in enumerate(deduped_dirs, 1):
         print(f"D{i:02d}. [{format_size(size):>10}] {path}")
     
-    return all_files[:limit], deduped_dirs
+    return top_files, deduped_dirs
 
 def is_mounted():
     return os.path.ismount(MOUNT_POINT)
@@ -116,6 +209,16 @@ def ensure_mounted():
         print("\nSent native mount request (AppleScript).")
         print("Please check for the 'Connect to Server' dialog if it appears.")
         
+        # The Finder mount is asynchronous: continue as soon as the volume appears
+        print(f"Waiting up to {MOUNT_TIMEOUT}s for mount at {MOUNT_POINT}...")
+        deadline = time.monotonic() + MOUNT_TIMEOUT
+        while time.monotonic() < deadline:
+            if is_mounted():
+                print("✅ Successfully mounted!")
+                return True
+            time.sleep(0.5)
+        
+        # Timed out (e.g. the dialog is still open), fall back to asking the user
         while True:
             choice = input(f"Waiting for mount at {MOUNT_POINT}... (Ready? [y]/Retry [r]/Cancel [c]): ").lower()
             if choice == 'y' or choice == '':
@@ -141,50 +244,83 @@ def backup_incremental():
     print("🚀 STARTING INCREMENTAL BACKUP")
     print("="*50)
 
-    for source in SOURCE_DIRS:
+    # Target directory structure: /Volumes/CloudRelay/Devices/<hostname>/Documents/...
+    target_base = f"{MOUNT_POINT}/Devices/{DEVICE_NAME}"
+    os.makedirs(target_base, exist_ok=True)
+    
+    # All sources live under HOME, so one rsync can take them as relative paths
+    home = os.path.expanduser("~")
+    rel_sources = []
+    for source, _, source_name in _SOURCE_PREFIXES:
         if not os.path.exists(source):
             continue
-            
-        # Target directory structure: /Volumes/CloudRelay/Devices/<hostname>/Documents/...
-        target_base = os.path.join(MOUNT_POINT, "Devices", DEVICE_NAME)
-        if not os.path.exists(target_base):
-            os.makedirs(target_base, exist_ok=True)
-            
-        target_dir = os.path.join(target_base, os.path.basename(source))
-        print(f"\nSyncing: {source} -> {target_dir}")
-        
-        # Ultimate rsync flags for WebDAV compatibility:
-        # -r: recursive, -t: preserve times, -v: verbose, -z: compress
-        # --inplace: write to files directly (CRITICAL for WebDAV)
-        # --size-only: skip checksums, rely on size and time (faster on network)
-        # --exclude: strictly ignore macOS noise and heavy dev junk
-        
-        try:
-            cmd = [
-                "rsync", "-rtvz", "--inplace", "--size-only", "--progress",
-                "--exclude", ".DS_Store",
-                "--exclude", "._*",
-                "--exclude", ".localized",
-                "--exclude", ".TemporaryItems",
-                "--exclude", ".Trashes",
-                "--exclude", ".git",           # Git history (can be massive)
-                "--exclude", "venv",           # Python Virtual Environments
-                "--exclude", ".venv",
-                "--exclude", "node_modules",   # JS Dependencies
-                "--exclude", "__pycache__",    # Python cache
-                "--exclude", ".cache",         # Generic cache
-                "--exclude", ".npm",           # NPM cache
-                "--exclude", "build",          # Build artifacts
-                "--exclude", "dist",
-                source + "/", target_dir
-            ]
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error backing up {source}: {e}")
+        print(f"Syncing: {source} -> {target_base}/{source_name}")
+        rel_sources.append(os.path.relpath(source, home))
+    
+    if not rel_sources:
+        print("\n✅ Backup finished successfully!")
+        return True
+    
+    # Ultimate rsync flags for WebDAV compatibility:
+    # -r: recursive, -t: preserve times, -h: human-readable sizes
+    # --inplace: write to files directly (CRITICAL for WebDAV)
+    # --size-only: skip checksums, rely on size and time (faster on network)
+    # --whole-file: skip the delta algorithm, which would re-read the destination over WebDAV
+    # --no-compress: zlib only burns CPU on a mounted share, and media is already compressed
+    # --files-from=-: read the source list from stdin, so a single rsync run builds one
+    #                 file list and scans the destination once for every source
+    # --exclude: strictly ignore macOS noise and heavy dev junk
+    cmd = [
+        "rsync", "-rth", "--inplace", "--size-only", "--whole-file", "--no-compress", "--progress",
+        "--files-from=-",
+        "--exclude", ".DS_Store",
+        "--exclude", "._*",
+        "--exclude", ".localized",
+        "--exclude", ".TemporaryItems",
+        "--exclude", ".Trashes",
+        "--exclude", ".git",           # Git history (can be massive)
+        "--exclude", "venv",           # Python Virtual Environments
+        "--exclude", ".venv",
+        "--exclude", "node_modules",   # JS Dependencies
+        "--exclude", "__pycache__",    # Python cache
+        "--exclude", ".cache",         # Generic cache
+        "--exclude", ".npm",           # NPM cache
+        "--exclude", "build",          # Build artifacts
+        "--exclude", "dist",
+        home + "/", target_base + "/"
+    ]
+    
+    try:
+        subprocess.run(cmd, input="\n".join(rel_sources) + "\n", text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"Error during backup: {e}")
             
     print("\n✅ Backup finished successfully!")
     return True
 
+def _remove_file(path):
+    """Deletes path with a single unlink; returns False if it was already gone."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # unlink refuses directories (EISDIR on Linux, EPERM on macOS)
+        if not os.path.isdir(path):
+            raise
+        shutil.rmtree(path)
+    return True
+
+def _rm_batch(paths):
+    """Removes all paths with a single 'rm -rf' instead of one Python call per path."""
+    if not paths:
+        return True
+    result = subprocess.run(["rm", "-rf", "--", *paths], check=False)
+    if result.returncode != 0:
+        print(f"❌ rm exited with code {result.returncode}; some items may not have been deleted.")
+        return False
+    return True
+
 def pre_backup_cleanup(scanned_files, scanned_dirs):
     """Allows user to delete files or directories BEFORE backup starts."""
     current_files = list(scanned_files)
@@ -224,8 +360,9 @@ def pre_backup_cleanup(scanned_files, scanned_dirs):
         to_delete = []
         
         if cmd.startswith('.'):
-            # Extension mode
-            to_delete = [(path, size, 'file', i) for i, (path, size) in enumerate(current_files) if path.lower().endswith(cmd)]
+            # Extension mode: lowercase only the path's tail, not the whole path
+            n = len(cmd)
+            to_delete = [(path, size, 'file', i) for i, (path, size) in enumerate(current_files) if path[-n:].lower() == cmd]
         else:
             # New improved parser for single numbers and ranges (e.g., F01, F05-F10)
             tokens = cmd.replace(',', ' ').split()
@@ -267,22 +404,26 @@ def pre_backup_cleanup(scanned_files, scanned_dirs):
         if confirm == 'YES':
             # Sort to_delete by index in reverse to pop correctly
             # We process files and dirs separately to maintain list integrity
-            file_back_indices = sorted([item[3] for item in to_delete if item[2] == 'file'], reverse=True)
-            dir_back_indices = sorted([item[3] for item in to_delete if item[2] == 'dir'], reverse=True)
+            file_back_indices = sorted({item[3] for item in to_delete if item[2] == 'file'}, reverse=True)
+            dir_back_indices = sorted({item[3] for item in to_delete if item[2] == 'dir'}, reverse=True)
             
             for f_idx in file_back_indices:
                 path = current_files[f_idx][0]
-                if os.path.exists(path):
-                    if os.path.isfile(path): os.remove(path)
-                    elif os.path.isdir(path): shutil.rmtree(path)
-                    print(f"✅ Deleted File: {path}")
+                try:
+                    if _remove_file(path):
+                        print(f"✅ Deleted File: {path}")
+                except OSError as e:
+                    print(f"❌ Error deleting {path}: {e}")
                 current_files.pop(f_idx)
+            
+            # Directory trees go to a single rm invocation
+            to_rm = [current_dirs[d_idx][0] for d_idx in dir_back_indices]
+            for path in to_rm:
+                print(f"🗑️  Deleting Directory: {path}")
+            if to_rm and _rm_batch(to_rm):
+                print(f"✅ Deleted {len(to_rm)} directories.")
                 
             for d_idx in dir_back_indices:
-                path = current_dirs[d_idx][0]
-                if os.path.exists(path):
-                    shutil.rmtree(path)
-                    print(f"✅ Deleted Directory: {path}")
                 current_dirs.pop(d_idx)
     
     return current_files
@@ -294,18 +435,18 @@ def cleanup_files(remaining_files):
         return
 
     # Group files by their source directory
-    dir_summary = {}
+    dir_summary = defaultdict(int)
     total_freed_space = 0
     
     for path, size in remaining_files:
         # Find which source dir this file belongs to
-        found_src = "Other"
-        for src in SOURCE_DIRS:
-            if path.startswith(src):
-                found_src = src
+        found_src = "Other Items"
+        for _, src_sep, src_name in _SOURCE_PREFIXES:
+            if path.startswith(src_sep):
+                found_src = src_name
                 break
         
-        dir_summary[found_src] = dir_summary.get(found_src, 0) + size
+        dir_summary[found_src] += size
         total_freed_space += size
 
     print("\n" + "="*50)
@@ -314,9 +455,8 @@ def cleanup_files(remaining_files):
     print("The following large files have been successfully backed up to CloudRelay.")
     print("You can now safely remove them from your Mac to free up space:\n")
 
-    for src_path, size in dir_summary.items():
+    for folder_name, size in dir_summary.items():
         # Display folder name (e.g., Downloads) and its removable size
-        folder_name = os.path.basename(src_path) if src_path != "Other" else "Other Items"
         print(f"📁 {folder_name:<15} : {format_size(size):>10} can be freed")
 
     print("-" * 50)
@@ -328,13 +468,11 @@ def cleanup_files(remaining_files):
     if confirm == 'YES':
         deleted_count = 0
         for path, _ in remaining_files:
-            if os.path.exists(path):
-                try:
-                    if os.path.isfile(path): os.remove(path)
-                    elif os.path.isdir(path): shutil.rmtree(path)
+            try:
+                if _remove_file(path):
                     deleted_count += 1
-                except Exception as e:
-                    print(f"❌ Error deleting {path}: {e}")
+            except Exception as e:
+                print(f"❌ Error deleting {path}: {e}")
         
         print(f"\n✅ Cleanup complete! Deleted {deleted_count} items. Mac is now {format_size(total_freed_space)} lighter.")
     else: